@@ -1,18 +1,202 @@
-import uuid
+import math
+import json
+import time
+import base64
+import asyncio
+import hashlib
 import os.path
-from datetime import datetime
-from typing import List, Dict, Optional
-
+import threading
+from datetime import date, datetime
+from collections import OrderedDict
+from itertools import islice, repeat
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Iterable, Union
+
+import numpy as np
+import pyarrow as pa
 import lancedb
-from lancedb.embeddings import get_registry
 
 import chromadb
 from chromadb.utils import embedding_functions
+from openai import OpenAI
 
 from mle.utils import get_config
 
 chromadb.logger.setLevel(chromadb.logging.ERROR)
 
+# the number of texts embedded and inserted at a time
+EMBEDDING_BATCH_SIZE = 256
+# the number of texts sent in one OpenAI embeddings request
+OPENAI_EMBEDDING_BATCH_SIZE = 512
+# the number of rows from which a LanceDB table gets an ANN index
+INDEX_THRESHOLD = 10_000
+# the number of new rows after which they are merged into the existing index
+INDEX_OPTIMIZE_ROWS = 5_000
+# the growth of a table (since the index was built) after which the index is rebuilt with more partitions
+INDEX_REBUILD_FACTOR = 2
+# the maximum number of LanceDB searches running concurrently in one query
+MAX_SEARCH_WORKERS = 8
+# the maximum number of embeddings kept in memory (about 60MB with 1536-dim vectors)
+EMBEDDING_CACHE_SIZE = 10_000
+
+
+def _bulk_uuid4(n: int) -> List[str]:
+    """
+    Generate `n` random (version 4) UUID strings at once, from a single `os.urandom` call
+    and a hex formatting, much faster than calling `uuid.uuid4()` for each of them.
+    :param n: the number of UUIDs to generate.
+    :return: the list of UUID strings.
+    """
+    raw = os.urandom(16 * n).hex()
+    ids = []
+    for i in range(0, 32 * n, 32):
+        h = raw[i:i + 32]
+        # set the version (4) and the RFC 4122 variant bits
+        ids.append(f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{'89ab'[int(h[16], 16) & 3]}{h[17:20]}-{h[20:]}")
+    return ids
+
+
+def _embed_openai(client: OpenAI, model: str, texts: List[str]) -> np.ndarray:
+    """
+    Compute the OpenAI embeddings of the texts in batched requests. The vectors are transferred
+    base64 encoded and decoded straight into float32 arrays, without going through Python floats.
+    :param client: the OpenAI client.
+    :param model: the embedding model.
+    :param texts: the texts to embed.
+    :return: the (N, dim) float32 embeddings, in the same order as the texts.
+    """
+    embeddings = []
+    for i in range(0, len(texts), OPENAI_EMBEDDING_BATCH_SIZE):
+        response = client.embeddings.create(
+            model=model,
+            input=texts[i:i + OPENAI_EMBEDDING_BATCH_SIZE],
+            encoding_format="base64",
+        )
+        embeddings.extend(
+            np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32)
+            for item in sorted(response.data, key=lambda e: e.index)
+        )
+    if not embeddings:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.vstack(embeddings)
+
+
+class _EmbeddingCache:
+
+    def __init__(self, client: OpenAI, model: str, maxsize: int = EMBEDDING_CACHE_SIZE):
+        """
+        A LRU cache of the OpenAI embeddings, keyed by the BLAKE2b digest of the texts, so the
+        repeated texts (in one call or across calls) are only sent to OpenAI once.
+        :param client: the OpenAI client.
+        :param model: the embedding model.
+        :param maxsize: the maximum number of cached embeddings.
+        """
+        self.client = client
+        self.model = model
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Compute the embeddings of the texts, only the texts missing from the cache are embedded.
+        :param texts: the texts to embed.
+        :return: the (N, dim) float32 embeddings, in the same order as the texts.
+        """
+        keys = [hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest() for text in texts]
+        vectors, misses = {}, {}
+        with self.lock:
+            for key, text in zip(keys, texts):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    vectors[key] = self.cache[key]
+                else:
+                    misses[key] = text
+
+        if misses:
+            embeds = _embed_openai(self.client, self.model, list(misses.values()))
+            with self.lock:
+                for key, embed in zip(misses, embeds):
+                    # copy the row, so the cache doesn't keep the whole batch array alive
+                    vectors[key] = self.cache[key] = embed.copy()
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.vstack([vectors[key] for key in keys])
+
+
+def datetime_from_us(timestamp: int) -> datetime:
+    """
+    Convert the `created_at` timestamp of a memory record (microseconds since the epoch) to a datetime.
+    :param timestamp: the timestamp in microseconds.
+    :return: the local datetime.
+    """
+    return datetime.fromtimestamp(timestamp / 1_000_000)
+
+
+def _json_default(value):
+    """
+    Encode the metadata values the json module doesn't support natively.
+    :param value: the value to encode.
+    :return: the plain Python value of numpy scalars and arrays, ISO format of dates.
+    """
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _memory_schema(dim: int) -> pa.Schema:
+    """
+    The Arrow schema of the LanceDB memory tables, the metadata is stored as JSON strings.
+    :param dim: the dimension of the embedding vectors.
+    :return: the schema.
+    """
+    return pa.schema([
+        pa.field("id", pa.string()),
+        pa.field("text", pa.string()),
+        pa.field("vector", pa.list_(pa.float32(), dim)),
+        pa.field("metadata", pa.string()),
+    ])
+
+
+def _to_arrow_table(
+    schema: pa.Schema,
+    ids: List[str],
+    texts: List[str],
+    embeds: np.ndarray,
+    metadata: List[Optional[Dict]],
+) -> pa.Table:
+    """
+    Build the Arrow table of a batch of memory records column by column, instead of row by row.
+    :param schema: the schema of the target table.
+    :param ids: the ids of the records.
+    :param texts: the texts of the records.
+    :param embeds: the (N, dim) float32 embeddings of the texts.
+    :param metadata: the metadata of the records.
+    :return: the Arrow table.
+    """
+    vector_type = schema.field("vector").type
+    vectors = pa.FixedSizeListArray.from_arrays(
+        pa.array(embeds.reshape(-1), type=vector_type.value_type), embeds.shape[1]
+    )
+    metadata_type = schema.field("metadata").type
+    if pa.types.is_string(metadata_type):
+        metadata = pa.array(
+            [json.dumps(meta, default=_json_default) if meta is not None else None for meta in metadata],
+            type=metadata_type
+        )
+    else:
+        # the tables created before the metadata was stored as JSON strings
+        metadata = pa.array(metadata, type=metadata_type)
+    return pa.Table.from_arrays(
+        [pa.array(ids, type=pa.string()), pa.array(texts, type=pa.string()), vectors, metadata],
+        names=["id", "text", "vector", "metadata"],
+    ).select(schema.names).cast(schema)
+
 
 class ChromaDBMemory:
 
@@ -33,18 +217,50 @@ class ChromaDBMemory:
         self.collection_name = 'memory'
         self.client = chromadb.PersistentClient(path=os.path.join(project_path, self.db_name))
 
+        # cache the collection handles, avoid the metadata lookups on every operation.
+        self.collections = {}
+        self.embedding_function = None
+        self.embedding_model = embedding_model
+        self.openai_client = None
+
         config = get_config(project_path)
         # use the OpenAI embedding function if the openai section is set in the configuration.
         if config['platform'] == 'OpenAI':
-            self.client.get_or_create_collection(
-                self.collection_name,
-                embedding_function=embedding_functions.OpenAIEmbeddingFunction(
-                    model_name=embedding_model,
-                    api_key=config['api_key']
-                )
+            self.openai_client = OpenAI(api_key=config['api_key'])
+            self.embedding_cache = _EmbeddingCache(self.openai_client, embedding_model)
+            self.embedding_function = embedding_functions.OpenAIEmbeddingFunction(
+                model_name=embedding_model,
+                api_key=config['api_key']
             )
-        else:
-            self.client.get_or_create_collection(self.collection_name)
+        self._get_collection(self.collection_name)
+
+    def _get_collection(self, name: str):
+        """
+        _get_collection: get the (cached) collection handle, create the collection if it doesn't exist.
+        Args:
+            name: the name of the collection.
+
+        Returns: the collection.
+        """
+        if name not in self.collections:
+            if self.embedding_function:
+                self.collections[name] = self.client.get_or_create_collection(
+                    name,
+                    embedding_function=self.embedding_function
+                )
+            else:
+                self.collections[name] = self.client.get_or_create_collection(name)
+        return self.collections[name]
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        _embed: compute the OpenAI embeddings of the texts, the repeated texts are served from the cache.
+        Args:
+            texts: the texts to embed.
+
+        Returns: the embeddings, in the same order as the texts.
+        """
+        return self.embedding_cache.embed(texts).tolist()
 
     def add_query(
             self,
@@ -69,17 +285,21 @@ class ChromaDBMemory:
         if idx:
             ids = idx
         else:
-            ids = [str(uuid.uuid4()) for _ in range(len(queries))]
+            ids = _bulk_uuid4(len(queries))
 
         if not collection:
             collection = self.collection_name
 
         query_list = [query['query'] for query in queries]
-        added_time = datetime.now().isoformat()
+        # store the time as an integer (microseconds since the epoch), see `datetime_from_us`
+        added_time = time.time_ns() // 1000
         resp_list = [{'response': query['response'], 'created_at': added_time} for query in queries]
+        # embed the queries outside of ChromaDB, so they are sent to OpenAI in batches
+        embeddings = self._embed(query_list) if self.openai_client else None
         # insert the record into the database
-        self.client.get_or_create_collection(collection).add(
+        self._get_collection(collection).add(
             documents=query_list,
+            embeddings=embeddings,
             metadatas=resp_list,
             ids=ids
         )
@@ -98,7 +318,37 @@ class ChromaDBMemory:
         """
         if not collection:
             collection = self.collection_name
-        return self.client.get_or_create_collection(collection).query(query_texts=query_texts, n_results=n_results)
+        return self._get_collection(collection).query(query_texts=query_texts, n_results=n_results)
+
+    async def aadd_query(
+            self,
+            queries: List[Dict[str, str]],
+            collection: str = None,
+            idx: List[str] = None
+    ):
+        """
+        aadd_query: the async version of `add_query`, runs the insertion in a worker thread
+        so it doesn't block the event loop.
+        Args:
+            queries: the queries to add to the memery.
+            collection: the name of the collection to add the queries.
+            idx: the ids of the queries.
+
+        Return: A list of generated IDs.
+        """
+        return await asyncio.to_thread(self.add_query, queries, collection, idx)
+
+    async def aquery(self, query_texts: List[str], collection: str = None, n_results: int = 5):
+        """
+        aquery: the async version of `query`, runs the query in a worker thread.
+        Args:
+            query_texts: the query texts to search in the memery.
+            collection: the name of the collection to search.
+            n_results: the number of results to return.
+
+        Returns: the top k results.
+        """
+        return await asyncio.to_thread(self.query, query_texts, collection, n_results)
 
     def peek(self, collection: str = None, n_results: int = 20):
         """
@@ -111,7 +361,7 @@ class ChromaDBMemory:
         """
         if not collection:
             collection = self.collection_name
-        return self.client.get_or_create_collection(collection).peek(limit=n_results)
+        return self._get_collection(collection).peek(limit=n_results)
 
     def get(self, collection: str = None, record_id: str = None):
         """
@@ -124,7 +374,7 @@ class ChromaDBMemory:
         """
         if not collection:
             collection = self.collection_name
-        collection = self.client.get_collection(collection)
+        collection = self._get_collection(collection)
         if not record_id:
             return collection.get()
 
@@ -138,6 +388,7 @@ class ChromaDBMemory:
         """
         if not collection_name:
             collection_name = self.collection_name
+        self.collections.pop(collection_name, None)
         return self.client.delete_collection(name=collection_name)
 
     def count(self, collection_name=None):
@@ -148,13 +399,22 @@ class ChromaDBMemory:
         """
         if not collection_name:
             collection_name = self.collection_name
-        return self.client.get_collection(name=collection_name).count()
+        return self._get_collection(collection_name).count()
+
+    async def acount(self, collection_name=None):
+        """
+        acount: the async version of `count`, runs the counting in a worker thread.
+        Args:
+            collection_name: the name of the collection to count.
+        """
+        return await asyncio.to_thread(self.count, collection_name)
 
     def reset(self):
         """
         reset: reset the memory.
         Notice: You may need to set the environment variable `ALLOW_RESET` to `TRUE` to enable this function.
         """
+        self.collections.clear()
         self.client.reset()
 
 
@@ -163,37 +423,47 @@ class LanceDBMemory:
     def __init__(
         self,
         project_path: str,
+        embedding_model: str = "text-embedding-ada-002",
     ):
         """
         Memory: A base class for memory and external knowledge management.
         Args:
             project_path: the path to store the data.
+            embedding_model: the OpenAI embedding model to use.
         """
         self.db_name = '.mle'
         self.table_name = 'memory'
         self.client = lancedb.connect(uri=self.db_name)
+        # the number of rows of the indexed tables when the index was built, and when it was last updated
+        self.indexed = {}
+        self.index_synced = {}
 
         config = get_config(project_path)
         if config["platform"] == "OpenAI":
-            self.text_embedding = get_registry().get("openai").create(api_key=config["api_key"])
+            self.openai_client = OpenAI(api_key=config["api_key"])
+            self.embedding_model = embedding_model
+            self.embedding_cache = _EmbeddingCache(self.openai_client, embedding_model)
         else:
             raise NotImplementedError
 
     def add(
         self,
-        texts: List[str],
-        metadata: Optional[List[Dict]] = None,
+        texts: Union[str, Iterable[str]],
+        metadata: Optional[Union[Dict, Iterable[Dict]]] = None,
         table_name: Optional[str] = None,
-        ids: Optional[List[str]] = None,
+        ids: Optional[Iterable[str]] = None,
     ) -> List[str]:
         """
         Adds a list of text items to the specified memory table in the database.
+        The texts are embedded and inserted in batches of `EMBEDDING_BATCH_SIZE`,
+        so a generator can be passed to ingest a large corpus without materializing it.
 
         Args:
-            texts (List[str]): A list of text strings to be added.
-            metadata (Optional[List[Dict]]): A list of metadata to be added.
+            texts (Union[str, Iterable[str]]): A list (or an iterable) of text strings to be added.
+            metadata (Optional[Union[Dict, Iterable[Dict]]]): A list of metadata to be added.
+                The values should be JSON serializable, numpy values and dates are converted.
             table_name (Optional[str]): The name of the table to add data to. Defaults to self.table_name.
-            ids (Optional[List[str]]): A list of unique IDs for the text items.
+            ids (Optional[Iterable[str]]): A list of unique IDs for the text items.
                 If not provided, random UUIDs are generated.
 
         Returns:
@@ -203,34 +473,109 @@ class LanceDBMemory:
             texts = (texts, )
 
         if metadata is None:
-            metadata = [None, ] * len(texts)
+            metadata = repeat(None)
         elif isinstance(metadata, dict):
             metadata = (metadata, )
-        else:
+        elif hasattr(texts, '__len__') and hasattr(metadata, '__len__'):
             assert len(texts) == len(metadata)
 
-        embeds = self.text_embedding.compute_source_embeddings(texts)
+        table_name = table_name or self.table_name
+        table = None
+        if table_name in self.client.table_names():
+            table = self.client.open_table(table_name)
+
+        texts, metadata = iter(texts), iter(metadata)
+        ids = iter(ids) if ids else None
+        added_ids = []
+        while True:
+            batch = list(islice(texts, EMBEDDING_BATCH_SIZE))
+            if not batch:
+                break
+
+            batch_ids = list(islice(ids, len(batch))) if ids else _bulk_uuid4(len(batch))
+            batch_metadata = list(islice(metadata, len(batch)))
+            embeds = self.embedding_cache.embed(batch)
+
+            # reuse the same table handle (and schema) for all the batches, the table is only created
+            # once the first batch has been built, so a failed batch doesn't leave an empty table behind
+            if table is None:
+                data = _to_arrow_table(_memory_schema(embeds.shape[1]), batch_ids, batch, embeds, batch_metadata)
+                table = self.client.create_table(table_name, data=data)
+            else:
+                table.add(_to_arrow_table(table.schema, batch_ids, batch, embeds, batch_metadata))
+            added_ids.extend(batch_ids)
+
+        if table is not None:
+            self._maintain_index(table_name, table)
+        return added_ids
+
+    def _maintain_index(self, table_name: str, table) -> None:
+        """
+        Keeps the vector index of the table up to date as it grows: the index is created once the table
+        reaches `INDEX_THRESHOLD` rows, the new rows are merged into it every `INDEX_OPTIMIZE_ROWS` rows,
+        and it is rebuilt (with more partitions) once the table has grown by `INDEX_REBUILD_FACTOR`.
 
+        Args:
+            table_name (str): The name of the table.
+            table: The opened table.
+        """
+        rows = table.count_rows()
+        if rows < INDEX_THRESHOLD:
+            return
+
+        if table_name not in self.indexed:
+            self.ensure_index(table_name)
+        elif rows >= self.indexed[table_name] * INDEX_REBUILD_FACTOR:
+            self.ensure_index(table_name, replace=True)
+        elif rows - self.index_synced[table_name] >= INDEX_OPTIMIZE_ROWS:
+            table.optimize()
+            self.index_synced[table_name] = rows
+
+    def ensure_index(
+        self,
+        table_name: Optional[str] = None,
+        num_partitions: Optional[int] = None,
+        num_sub_vectors: int = 96,
+        metric: str = "L2",
+        replace: bool = False,
+    ) -> None:
+        """
+        Creates an IVF-PQ vector index on the specified memory table if it doesn't have one yet,
+        so the searches don't need to scan every vector in the table. If the table is already indexed,
+        the rows added since are merged into the existing index.
+
+        Args:
+            table_name (Optional[str]): The name of the table to index. Defaults to self.table_name.
+            num_partitions (Optional[int]): The number of IVF partitions. Defaults to sqrt(number of rows).
+            num_sub_vectors (int): The number of PQ sub-vectors, should divide the vector dimension. Default is 96.
+            metric (str): The distance metric, should match the one used in search. Default is "L2".
+            replace (bool): Rebuild the index even if the table already has one. Default is False.
+        """
         table_name = table_name or self.table_name
-        ids = ids or [str(uuid.uuid4()) for _ in range(len(texts))]
-
-        data = [
-            {
-                "vector": embed,
-                "text": text,
-                "id": idx,
-                "metadata": meta,
-            } for idx, text, embed, meta in zip(ids, texts, embeds, metadata)
-        ]
-
-        if table_name not in self.client.table_names():
-            self.client.create_table(table_name, data=data)
+        table = self.client.open_table(table_name)
+        rows = table.count_rows()
+        if replace or not table.list_indices():
+            table.create_index(
+                metric=metric,
+                num_partitions=num_partitions or max(1, int(math.sqrt(rows))),
+                num_sub_vectors=num_sub_vectors,
+                vector_column_name="vector",
+                replace=True,
+            )
+            self.indexed[table_name] = rows
         else:
-            self.client.open_table(table_name).add(data=data)
-
-        return ids
+            table.optimize()
+            self.indexed.setdefault(table_name, rows)
+        self.index_synced[table_name] = rows
 
-    def query(self, query_texts: List[str], table_name: Optional[str] = None, n_results: int = 5) -> List[List[dict]]:
+    def query(
+        self,
+        query_texts: List[str],
+        table_name: Optional[str] = None,
+        n_results: int = 5,
+        nprobes: int = 20,
+        refine_factor: int = 10,
+    ) -> List[List[dict]]:
         """
         Queries the specified memory table for similar text embeddings.
 
@@ -238,6 +583,9 @@ class LanceDBMemory:
             query_texts (List[str]): A list of query text strings.
             table_name (Optional[str]): The name of the table to query. Defaults to self.table_name.
             n_results (int): The maximum number of results to retrieve per query. Default is 5.
+            nprobes (int): The number of index partitions to search, only used once the table is indexed.
+            refine_factor (int): Re-rank `refine_factor * n_results` candidates with the full vectors,
+                only used once the table is indexed.
 
         Returns:
             List[List[dict]]: A list of results for each query text, each result being a dictionary with
@@ -245,9 +593,18 @@ class LanceDBMemory:
         """
         table_name = table_name or self.table_name
         table = self.client.open_table(table_name)
-        query_embeds = self.text_embedding.compute_source_embeddings(query_texts)
-
-        results = [table.search(query).limit(n_results).to_list() for query in query_embeds]
+        query_embeds = self.embedding_cache.embed(query_texts)
+
+        def search(query):
+            rows = table.search(query).nprobes(nprobes).refine_factor(refine_factor).limit(n_results).to_list()
+            for row in rows:
+                if isinstance(row.get("metadata"), str):
+                    row["metadata"] = json.loads(row["metadata"])
+            return rows
+
+        # LanceDB releases the GIL while searching, run the searches of the queries concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_SEARCH_WORKERS, len(query_embeds)))) as pool:
+            results = list(pool.map(search, query_embeds))
         return results
 
     def delete(self, record_id: str, table_name: Optional[str] = None) -> bool:
@@ -276,6 +633,8 @@ class LanceDBMemory:
             bool: True if the table was successfully dropped, False otherwise.
         """
         table_name = table_name or self.table_name
+        self.indexed.pop(table_name, None)
+        self.index_synced.pop(table_name, None)
         return self.client.drop_table(table_name)
 
     def count(self, table_name: Optional[str] = None) -> int:
@@ -1,7 +1,9 @@
 import os
 import re
+import copy
 import uuid
 import yaml
+import functools
 import base64
 import shutil
 import requests
@@ -13,6 +15,9 @@ from rich.panel import Panel
 from rich.prompt import Prompt
 from rich.console import Console
 
+# use the libyaml based loader if it is available, much faster than the pure Python one
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 def dict_to_markdown(data: Dict[str, Any], file_path: str) -> None:
     """
@@ -114,11 +119,28 @@ def get_config(workdir: str = None) -> Optional[Dict[str, Any]]:
     """
     config_dir = os.path.join(workdir or os.getcwd(), '.mle')
     config_path = os.path.join(config_dir, 'project.yml')
-    if not os.path.exists(config_path):
+    try:
+        stat = os.stat(config_path)
+    except OSError:
+        # missing file, `.mle` not being a directory, no permission, etc.
         return None
 
+    # the cached object is shared, return a copy so the callers can modify it freely
+    return copy.deepcopy(_load_config(config_path, stat.st_mtime_ns, stat.st_size))
+
+
+@functools.lru_cache(maxsize=32)
+def _load_config(config_path: str, mtime_ns: int, size: int) -> Optional[Dict[str, Any]]:
+    """
+    Load and parse the configuration file, cached by its modification time and size,
+    so the file is only parsed again after it has been changed.
+    :param config_path: the path of the configuration file.
+    :param mtime_ns: the modification time of the file, in nanoseconds.
+    :param size: the size of the file.
+    :return: the configuration.
+    """
     with open(config_path, 'r') as file:
-        return yaml.safe_load(file)
+        return yaml.load(file, Loader=_YAML_LOADER)
 
 
 def write_config(value: Dict[str, Any], workdir: str = None) -> None:
@@ -130,6 +152,8 @@ def write_config(value: Dict[str, Any], workdir: str = None) -> None:
     os.makedirs(config_dir, exist_ok=True)
     with open(config_path, 'w') as file:
         yaml.dump(value, file, default_flow_style=False)
+    # don't rely on the timestamp resolution to notice the rewrite (e.g. same size, same second)
+    _load_config.cache_clear()
 
 
 def delete_directory(path: str) -> bool:
@@ -2,15 +2,168 @@
 Chat Mode: the mode to have an interactive chat with LLM to work on ML project.
 """
 import os
+import time
+import queue
+import threading
 import questionary
 from rich.live import Live
 from rich.panel import Panel
-from rich.console import Console
-from rich.markdown import Markdown
+from rich.console import Console, Group, NewLine
+from rich.markdown import Markdown, UnknownElement
 from mle.model import load_model
 from mle.utils import print_in_box, WorkflowCache
 from mle.agents import ChatAgent
 
+# minimal interval (in seconds) between two re-renders of the streaming response
+REFRESH_INTERVAL = 0.1
+# the maximum number of responses buffered ahead of the rendering
+MAX_PREFETCH = 32
+# marks the end of a response stream produced in the background
+STREAM_END = object()
+
+
+def render_response(body):
+    """
+    Render the (partial) response of the chatbot.
+    :param body: the response renderable.
+    :return: the renderable panel.
+    """
+    return Panel(body, title="[bold magenta]MLE-Agent[/]", border_style="magenta")
+
+
+def stream_in_background(generator, interval: float = REFRESH_INTERVAL):
+    """
+    Consume the generator in a background thread, so receiving the response from the model
+    is not blocked by the rendering, and yield the latest item at most once per interval.
+    At most `MAX_PREFETCH` items are buffered, the producer waits when the rendering falls behind,
+    and stops (closing the generator) when the consumer stops early.
+    The last item is always yielded, the exception raised by the generator is re-raised.
+    :param generator: the generator of the accumulated response text.
+    :param interval: the minimal interval (in seconds) between two yielded items.
+    :return: the generator of the latest items.
+    """
+    items = queue.Queue(maxsize=MAX_PREFETCH)
+    # set when the consumer stops early, so the producer doesn't wait on a full queue forever
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in generator:
+                if not put(item):
+                    break
+        except BaseException as e:
+            # forward everything (e.g. SystemExit), a truncated stream must not look complete
+            put(e)
+        finally:
+            # release the model stream when the consumer has gone away
+            if stop.is_set() and hasattr(generator, 'close'):
+                generator.close()
+            put(STREAM_END)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        latest, pending, last_yield = None, False, 0.0
+        while True:
+            # wait until the pending item is due, or block until the next one arrives
+            timeout = max(0.0, last_yield + interval - time.monotonic()) if pending else None
+            try:
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is STREAM_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            if item is not None:
+                latest, pending = item, True
+
+            if pending and time.monotonic() - last_yield >= interval:
+                yield latest
+                pending, last_yield = False, time.monotonic()
+
+        if pending:
+            yield latest
+    finally:
+        stop.set()
+
+
+class MarkdownStream:
+
+    def __init__(self):
+        """
+        MarkdownStream: incrementally render a streaming markdown response. The completed top-level
+        blocks are parsed only once and cached, only the trailing unstable block is re-parsed on each update.
+        """
+        # the cached chunks, as (markdown, starts with a leaf block, ends with a blank line)
+        self.stable_blocks = []
+        self.offset = 0
+
+    @staticmethod
+    def _top_level_blocks(markdown: Markdown):
+        """
+        _top_level_blocks: the opening tokens of the top-level blocks, as found by the markdown parser.
+        :param markdown: the parsed markdown.
+        :return: the list of tokens.
+        """
+        return [token for token in markdown.parsed if token.level == 0 and token.nesting != -1 and token.map]
+
+    @staticmethod
+    def _spacing(markdown: Markdown, blocks):
+        """
+        _spacing: how the chunk joins its neighbours. Rich puts a blank line before a block when the
+        previously closed element has `new_line`, which only matters for the leaf blocks: the
+        containers (quotes, lists, tables) get it from their own children.
+        :param markdown: the parsed chunk.
+        :param blocks: the top-level blocks of the chunk.
+        :return: whether the chunk starts with a leaf block, and whether it ends with `new_line`.
+        """
+        if not blocks:
+            return False, False
+        first, last = blocks[0], blocks[-1]
+        element = markdown.elements.get(last.type, UnknownElement)
+        return first.nesting == 0 or first.type in ('paragraph_open', 'heading_open'), element.new_line
+
+    def update(self, text: str):
+        """
+        update: render the accumulated response text.
+        :param text: the full response text received so far.
+        :return: the renderable group.
+        """
+        tail = Markdown(text[self.offset:])
+        blocks = self._top_level_blocks(tail)
+        complete_lines = tail.markup.count('\n')
+        # a block is complete once the next block has started on a complete line, as the
+        # first line of a block may still turn out to continue the previous one (e.g. "2.")
+        last = next((i for i in range(len(blocks) - 1, 0, -1) if blocks[i].map[0] < complete_lines), None)
+        if last is not None:
+            cut = 0
+            for _ in range(blocks[last].map[0]):
+                cut = tail.markup.index('\n', cut) + 1
+            block = Markdown(tail.markup[:cut])
+            self.stable_blocks.append((block, *self._spacing(block, self._top_level_blocks(block))))
+            self.offset += cut
+            tail = Markdown(tail.markup[cut:])
+            blocks = self._top_level_blocks(tail)
+
+        chunks = self.stable_blocks + [(tail, *self._spacing(tail, blocks))]
+        renderables = [chunks[0][0]]
+        for (_, _, new_line), (markdown, leaf, _) in zip(chunks, chunks[1:]):
+            if new_line and leaf:
+                renderables.append(NewLine())
+            renderables.append(markdown)
+        return Group(*renderables)
+
 
 def chat(work_dir: str, model=None):
     console = Console()
@@ -30,12 +183,12 @@ def chat(work_dir: str, model=None):
             try:
                 user_pmpt = questionary.text("[Exit/Ctrl+D]: ").ask()
                 if user_pmpt:
-                    with Live(console=Console()) as live:
-                        for text in chatbot.chat(user_pmpt.strip()):
-                            live.update(
-                                Panel(Markdown(text), title="[bold magenta]MLE-Agent[/]", border_style="magenta"),
-                                refresh=True
-                            )
+                    with Live(console=Console(), auto_refresh=False) as live:
+                        # re-parsing the whole markdown on every token is quadratic, throttle the rendering
+                        text, stream = '', MarkdownStream()
+                        for text in stream_in_background(chatbot.chat(user_pmpt.strip())):
+                            live.update(render_response(stream.update(text)), refresh=True)
+                        live.update(render_response(Markdown(text)), refresh=True)
                 ca.store("conversation", chatbot.chat_history)
             except (KeyboardInterrupt, EOFError):
                 break